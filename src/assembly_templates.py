@@ -1,16 +1,27 @@
-import StringIO
+import itertools
 import sys
 
 class RawBytes(object):
     """A sequence of literal bytes to appear in an assembly language template."""
-    def __init__(self, *bytes):
-        self.bytes = bytes
+    IS_FIELD = False
+
+    def __init__(self, *byte_values):
+        self.bytes = bytes(byte_values)
+
+    @classmethod
+    def from_bytes(cls, raw):
+        """Make a RawBytes directly from a bytes object, skipping varargs."""
+        chunk = cls.__new__(cls)
+        chunk.bytes = raw
+        return chunk
 
     def __len__(self):
         return len(self.bytes)
 
 class Field(object):
     """A variable field of bytes."""
+    IS_FIELD = True
+
     def __init__(self, name, byte_length):
         self.name = name
         self.byte_length = byte_length
@@ -31,32 +42,36 @@ class AssemblyTemplate(object):
         # Merge consecutive RawBytes elements together for efficiency of
         # matching and for simplicity of template expansion.
         merged_chunks = []
-        current_raw_bytes = []
+        current_raw_bytes = bytearray()
         for c in chunks:
-            if isinstance(c, Field):
+            if c.IS_FIELD:
                 # Push any raw bytes before this.
                 if current_raw_bytes:
-                    merged_chunks.append(RawBytes(*current_raw_bytes))
-                    current_raw_bytes = []
+                    merged_chunks.append(RawBytes.from_bytes(bytes(current_raw_bytes)))
+                    del current_raw_bytes[:]
                 merged_chunks.append(c)
             else:
                 current_raw_bytes.extend(c.bytes)
         # Merge in trailing raw bytes.
         if current_raw_bytes:
-            merged_chunks.append(RawBytes(*current_raw_bytes))
+            merged_chunks.append(RawBytes.from_bytes(bytes(current_raw_bytes)))
         self.chunks = merged_chunks
+        # The chunk list is immutable from here on, so compute the derived
+        # views once rather than on every call.
+        self._fields = tuple(c for c in merged_chunks if c.IS_FIELD)
+        raw = bytearray()
+        for c in merged_chunks:
+            if c.IS_FIELD:
+                raw.extend(b'\0' * len(c))
+            else:
+                raw.extend(c.bytes)
+        self._bytes = bytes(raw)
 
     def fields(self):
-        return [c for c in self.chunks if isinstance(c, Field)]
+        return self._fields
 
     def bytes(self):
-        bytes = []
-        for c in self.chunks:
-            if isinstance(c, Field):
-                bytes.extend([0] * len(c))
-            else:
-                bytes.extend(c.bytes)
-        return bytes
+        return self._bytes
 
 templates = {
     'X86SysenterVsyscallImplementation': AssemblyTemplate(
@@ -146,79 +161,106 @@ templates = {
     ),
 }
 
-def byte_array_name(name):
-    return '%s_bytes' % name
+# Integer types we can use to compare or store a span of template bytes in
+# one access, keyed by width in bytes.
+tile_types = { 8: 'uint64_t', 4: 'uint32_t', 2: 'uint16_t', 1: 'uint8_t' }
+tile_suffixes = { 8: 'ull', 4: 'u', 2: '', 1: '' }
+
+def split_into_tiles(offset, length):
+    """Greedily cover [offset, offset+length) with the widest loads/stores
+    that keep each access naturally aligned relative to the buffer start."""
+    tiles = []
+    while length > 0:
+        for size in (8, 4, 2, 1):
+            if size <= length and offset % size == 0:
+                break
+        tiles.append((offset, size))
+        offset += size
+        length -= size
+    return tiles
+
+# Hex literals for every byte value, precomputed so single-byte tiles (the
+# common case at odd offsets and tails) need no per-byte formatting.
+_HEX_BYTE = tuple('0x%x' % i for i in range(256))
 
-def generate_match_method(byte_array, template):
-    s = StringIO.StringIO()
-    fields = template.fields()
-    field_types = [f.c_type() for f in fields]
-    field_names = [f.name for f in fields]
-    args = ', ' + ', '.join("%s* %s" % (t, n) for t, n in zip(field_types, field_names)) \
+def tile_literal(chunk, start, size):
+    """The C integer literal for chunk.bytes[start:start+size], little-endian."""
+    if size == 1:
+        return _HEX_BYTE[chunk.bytes[start]]
+    value = 0
+    for i in range(size):
+        value |= chunk.bytes[start + i] << (8 * i)
+    return f'0x{value:x}{tile_suffixes[size]}'
+
+def template_layout(template):
+    """(chunk, offset, length) triples for each chunk of the template."""
+    offsets = itertools.accumulate((len(c) for c in template.chunks),
+                                   initial=0)
+    return [(c, offset, len(c)) for c, offset in zip(template.chunks, offsets)]
+
+def generate_match_method(layout):
+    fields = [chunk for chunk, _, _ in layout if chunk.IS_FIELD]
+    args = ', ' + ', '.join(f'{f.c_type()}* __restrict__ {f.name}' for f in fields) \
            if fields else ''
-    
-    s.write('  static bool match(const uint8_t* buffer %s) {\n' % (args,))
-    offset = 0
-    for chunk in template.chunks:
-        if isinstance(chunk, Field):
-            field_name = chunk.name
-            s.write('    memcpy(%s, &buffer[%d], sizeof(*%s));\n'
-                    % (field_name, offset, field_name))
-        else:
-            s.write('    if (memcmp(&buffer[%d], &%s[%d], %d) != 0) { return false; }\n'
-                    % (offset, byte_array, offset, len(chunk)))
-        offset += len(chunk)
-    s.write('    return true;\n')
-    s.write('  }')
-    return s.getvalue()
-
-def generate_substitute_method(byte_array, template):
-    s = StringIO.StringIO()
-    fields = template.fields()
-    field_types = [f.c_type() for f in fields]
-    field_names = [f.name for f in fields]
-    args = ', ' + ', '.join("%s %s" % (t, n) for t, n in zip(field_types, field_names)) \
+    lines = [f'  __attribute__((always_inline)) static bool match(const uint8_t* __restrict__ buffer {args}) {{']
+    # Extract the fields first; the stores are unconditional, so the
+    # compare cascade below is the only control flow in the method.
+    for chunk, offset, length in layout:
+        if chunk.IS_FIELD:
+            lines.append(f'    __builtin_memcpy({chunk.name}, &buffer[{offset}], {chunk.byte_length});')
+    # Compare each span with the widest naturally-aligned loads we can,
+    # against immediates baked in from the template bytes.  OR the XOR
+    # diffs together so there is a single well-predicted branch at the
+    # end instead of one per span.
+    lines.append('    uint64_t diff = 0;')
+    for chunk, offset, length in layout:
+        if chunk.IS_FIELD:
+            continue
+        for tile_offset, size in split_into_tiles(offset, length):
+            literal = tile_literal(chunk, tile_offset - offset, size)
+            lines.append(f'    diff |= *(const {tile_types[size]}*)(buffer + {tile_offset})'
+                         f' ^ {literal};')
+    lines.append('    return diff == 0;')
+    lines.append('  }')
+    return '\n'.join(lines)
+
+def generate_substitute_method(layout):
+    fields = [chunk for chunk, _, _ in layout if chunk.IS_FIELD]
+    args = ', ' + ', '.join(f'{f.c_type()} {f.name}' for f in fields) \
            if fields else ''
-    
-    s.write('  static void substitute(uint8_t* buffer %s) {\n' % (args,))
-    offset = 0
-    for chunk in template.chunks:
-        if isinstance(chunk, Field):
-            field_name = chunk.name
-            s.write('    memcpy(&buffer[%d], &%s, sizeof(%s));\n'
-                    % (offset, field_name, field_name))
+    lines = [f'  __attribute__((always_inline)) static void substitute(uint8_t* __restrict__ buffer {args}) {{']
+    for chunk, offset, length in layout:
+        if chunk.IS_FIELD:
+            lines.append(f'    __builtin_memcpy(&buffer[{offset}], &{chunk.name}, {chunk.byte_length});')
         else:
-            s.write('    memcpy(&buffer[%d], &%s[%d], %d);\n'
-                    % (offset, byte_array, offset, len(chunk)))
-        offset += len(chunk)
-    s.write('  }')
-    return s.getvalue()
-
-def generate_field_end_methods(byte_array, template):
-    s = StringIO.StringIO()
-    offset = 0
-    for chunk in template.chunks:
-        offset += len(chunk)
-        if isinstance(chunk, Field):
-            s.write('  static const size_t %s_end = %d;\n' % (chunk.name, offset))
-    return s.getvalue()
-
-def generate_size_member(byte_array):
-    s = StringIO.StringIO()
-    s.write('  static const size_t size = sizeof(%s);' % byte_array)
-    return s.getvalue()
+            # Store the span with the widest naturally-aligned stores we
+            # can, with the template bytes baked in as immediates.
+            for tile_offset, size in split_into_tiles(offset, length):
+                literal = tile_literal(chunk, tile_offset - offset, size)
+                lines.append(f'    *({tile_types[size]}*)(buffer + {tile_offset})'
+                             f' = {literal};')
+    lines.append('  }')
+    return '\n'.join(lines)
+
+def generate_field_end_methods(layout):
+    return ''.join(f'  static const size_t {chunk.name}_end = {offset + length};\n'
+                   for chunk, offset, length in layout
+                   if chunk.IS_FIELD)
+
+def generate_size_member(template):
+    return f'  static const size_t size = {len(template.bytes())};'
 
 def generate(f):
-    # Raw bytes.
-    for name, template in templates.iteritems():
-        bytes = template.bytes()
-        f.write('static const uint8_t %s[] = { %s };\n'
-                % (byte_array_name(name), ', '.join(['0x%x' % b for b in bytes])))
-    f.write('\n')
-
-    # Objects representing assembly templates.
-    for name, template in templates.iteritems():
-        byte_array = byte_array_name(name)
+    f.write("""#ifndef __GNUC__
+#define __builtin_memcpy memcpy
+#define __restrict__
+#endif
+
+""")
+    # Objects representing assembly templates.  The template bytes are baked
+    # into the generated code as immediates, so no byte arrays are emitted.
+    for name, template in sorted(templates.items()):
+        layout = template_layout(template)
         f.write("""class %(class_name)s {
 public:
 %(match_method)s
@@ -229,8 +271,8 @@ public:
 %(size_member)s
 };
 """ % { 'class_name': name,
-        'match_method': generate_match_method(byte_array, template),
-        'substitute_method': generate_substitute_method(byte_array, template),
-        'field_end_methods': generate_field_end_methods(byte_array, template),
-        'size_member': generate_size_member(byte_array), })
+        'match_method': generate_match_method(layout),
+        'substitute_method': generate_substitute_method(layout),
+        'field_end_methods': generate_field_end_methods(layout),
+        'size_member': generate_size_member(template), })
         f.write('\n\n')
@@ -1,7 +1,7 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
 import assembly_templates
-import StringIO
+from io import StringIO
 import os
 import string
 import sys
@@ -10,7 +10,7 @@ import syscalls
 def write_syscall_enum(f, arch):
     f.write("enum Syscalls {\n")
     undefined_syscall = -1
-    for name, obj in sorted(syscalls.all(), key=lambda x: getattr(x[1], arch)):
+    for name, obj in sorted(syscalls.all(), key=lambda x: (getattr(x[1], arch) is not None, getattr(x[1], arch) or 0)):
         syscall_number = getattr(obj, arch)
         if syscall_number is not None:
             enum_number = syscall_number
@@ -25,7 +25,7 @@ def write_syscall_enum(f, arch):
 def write_syscall_enum_for_tests(f, arch):
     f.write("enum Syscalls {\n")
     undefined_syscall = -1
-    for name, obj in sorted(syscalls.all(), key=lambda x: getattr(x[1], arch)):
+    for name, obj in sorted(syscalls.all(), key=lambda x: (getattr(x[1], arch) is not None, getattr(x[1], arch) or 0)):
         syscall_number = getattr(obj, arch)
         if syscall_number is not None:
             enum_number = syscall_number
@@ -151,7 +151,7 @@ def main(argv):
     else:
         before = ""
 
-    stream = StringIO.StringIO()
+    stream = StringIO()
     generators_for[base](stream)
     after = stream.getvalue()
     stream.close()
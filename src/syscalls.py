@@ -11,7 +11,7 @@ class BaseSyscall(object):
         assert x86 or x64       # Must exist on one architecture.
         self.x86 = x86
         self.x64 = x64
-        assert len(kwargs) is 0
+        assert len(kwargs) == 0
 
 class RestartSyscall(BaseSyscall):
     """A special class for the restart_syscall syscall."""
@@ -1681,7 +1681,7 @@ epoll_ctl_old = UnsupportedSyscall(x64=214)
 epoll_wait_old = UnsupportedSyscall(x64=215)
 
 def _syscalls():
-    for name, obj in globals().iteritems():
+    for name, obj in globals().items():
         if isinstance(obj, BaseSyscall):
             yield name, obj
 